@@ -1,18 +1,41 @@
 #!/usr/bin/env python3
+import collections
+import contextlib
 import datetime
-import hashlib
+import itertools
 import logging
 import multiprocessing
 import os
 import shutil
+import sqlite3
 import subprocess
 import sys
+import tarfile
+import tempfile
+import time
+from concurrent.futures import as_completed
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
 from pathlib import Path
+from typing import BinaryIO
+from typing import Optional
+from typing import Set
 
+import blake3
 import click
 import ncbi_genome_download
+import requests
 from tqdm import tqdm
 
+try:
+    from isal import igzip as gzip
+    from isal import isal_zlib as gzip_zlib
+except ImportError:
+    import gzip
+    import zlib as gzip_zlib
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
@@ -20,26 +43,217 @@ logger.addHandler(logging.StreamHandler())
 
 NCBI_SERVER = "https://ftp.ncbi.nlm.nih.gov"
 
+# Genomes are concatenated into shards of about this many uncompressed bytes before adding to library
+SHARD_SIZE = 1 << 30
+
+# Shards added at once. Each one is a SHARD_SIZE temporary file in library/
+# until kraken2-build has copied it, so this bounds the extra disk in use.
+SHARD_WORKERS = 2
+
+# Added hashes are appended to a log which is compacted once it reaches this size
+HASHES_LOG_SIZE = 1 << 20
+
+# Raised while reading a truncated or corrupt gzip file
+GZIP_ERRORS = (OSError, EOFError, gzip_zlib.error)
+
+# blake3 digests and fingerprints are both 32 bytes
+DIGEST_SIZE = 32
+
 
 DB_TYPE_CONFIG = {
     'standard': ("archaea", "bacteria", "viral", "plasmid", "human", "UniVec_Core")
 }
-hashes = set()
-md5_file = None
 
 
-def hash_file(filename, buf_size=8192):
-    md5 = hashlib.md5()
-    with open(filename, "rb") as in_file:
+@dataclass
+class LibraryState:
+    # Digests of genomes in the library, owned by the thread adding to it
+    hashes_file: Path
+    hashes: Set[bytes]
+    hashes_log: Optional[BinaryIO] = None
+
+
+@contextlib.contextmanager
+def open_genome(filename, buf_size=1 << 20):
+    # Downloaded genomes stay compressed and are inflated while being read.
+    # gzip pulls compressed data 8 KiB at a time, so buffer the file underneath.
+    if str(filename).endswith(".gz"):
+        with open(filename, "rb", buffering=buf_size) as raw_file, \
+                gzip.GzipFile(fileobj=raw_file, mode="rb") as in_file:
+            yield in_file
+        return
+
+    # buffers used for genomes are larger than io's, read straight from the raw file
+    with open(filename, "rb", buffering=0) as in_file:
+        yield in_file
+
+
+def hash_file(filename, buf_size=1 << 22, max_threads=blake3.blake3.AUTO, mmap_size=10 << 20):
+    # Compressed genomes hash to the digest of their contents
+    hasher = blake3.blake3(max_threads=max_threads)
+    if not str(filename).endswith(".gz") and os.path.getsize(filename) >= mmap_size:
+        # blake3 maps large genomes itself and hashes them with the GIL released
+        hasher.update_mmap(filename)
+        return hasher.digest()
+
+    buf = bytearray(buf_size)
+    mv = memoryview(buf)
+    with open_genome(filename) as in_file:
+        if hasattr(os, "posix_fadvise"):
+            # Widen the kernel readahead window for the sequential scan
+            os.posix_fadvise(in_file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
         while True:
-            data = in_file.read(buf_size)
-            if not data:
+            size = in_file.readinto(buf)
+            if not size:
                 break
-            md5.update(data)
-    digest = md5.hexdigest()
+            hasher.update(mv[:size])
+    digest = hasher.digest()
     return digest
 
 
+def fast_fingerprint(filename, window=4096):
+    # Size plus the first and last few KiB, enough to detect a changed file.
+    # These are the bytes on disk, so a .fna.gz is fingerprinted compressed and
+    # the same genome stored as .fna and as .fna.gz gets different fingerprints.
+    size = os.path.getsize(filename)
+    hasher = blake3.blake3()
+    with open(filename, "rb") as in_file:
+        hasher.update(in_file.read(window))
+        if size > window:
+            in_file.seek(max(size - window, window))
+            hasher.update(in_file.read(window))
+    hasher.update(size.to_bytes(8, "little"))
+    return hasher.digest()
+
+
+def digest_sidecar(file, fast_hash=False):
+    suffix = "fingerprint" if fast_hash else "blake3"
+    return f"{file}.{suffix}"
+
+
+def read_digest_sidecar(file, fast_hash=False):
+    sidecar = digest_sidecar(file, fast_hash)
+    if not os.path.exists(sidecar):
+        return None
+
+    with open(sidecar, "rb") as in_file:
+        digest = in_file.read()
+
+    # A truncated sidecar is treated as missing and the file is hashed again
+    return digest if len(digest) == DIGEST_SIZE else None
+
+
+def write_digest_sidecar(file, digest, fast_hash=False):
+    with open(digest_sidecar(file, fast_hash), "wb") as fh:
+        fh.write(digest)
+
+
+def compute_digest(file, max_threads=blake3.blake3.AUTO, fast_hash=False):
+    if fast_hash:
+        return fast_fingerprint(file)
+    return hash_file(file, max_threads=max_threads)
+
+
+def hash_genome(file, max_threads=blake3.blake3.AUTO, fast_hash=False):
+    # Like gunzip -k did, a truncated or corrupt download is skipped instead of failing the build
+    try:
+        return compute_digest(file, max_threads, fast_hash)
+    except GZIP_ERRORS as e:
+        logger.warning(f"Failed to hash {file}, skipping it: {e}")
+        return None
+
+
+def get_file_digest(file, max_threads=blake3.blake3.AUTO, fast_hash=False):
+    digest = read_digest_sidecar(file, fast_hash)
+    if digest is None:
+        digest = hash_genome(file, max_threads, fast_hash)
+        if digest is not None:
+            write_digest_sidecar(file, digest, fast_hash)
+    return digest
+
+
+def find_files(directory, pattern):
+    return [str(path) for path in directory.rglob(pattern) if path.is_file()]
+
+
+def gunzip_file(path, command=None):
+    # Like gunzip -k, keep the archive. Outputs newer than the archive are up to date.
+    out_path = path[:-3]
+    if os.path.exists(out_path) and os.path.getmtime(out_path) >= os.path.getmtime(path):
+        return
+
+    tmp_path = f"{out_path}.part"
+    try:
+        if command:
+            with open(tmp_path, "wb") as out_file:
+                subprocess.run(command + [path], stdout=out_file, check=True)
+        else:
+            with gzip.open(path, "rb") as in_file, open(tmp_path, "wb") as out_file:
+                shutil.copyfileobj(in_file, out_file, length=1 << 20)
+    except subprocess.CalledProcessError as e:
+        logger.warning(f"{command[0]} failed on {path}, decompressing in process: {e}")
+        os.remove(tmp_path)
+        return gunzip_file(path)
+    except GZIP_ERRORS as e:
+        logger.warning(f"Failed to decompress {path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return
+
+    os.replace(tmp_path, out_path)
+
+
+def parallel_gunzip_command(threads):
+    # The accession maps are a few multi-GB archives, so prefer tools that
+    # inflate one archive on several cores over ones that only split I/O off
+    if shutil.which("rapidgzip"):
+        return ["rapidgzip", "-d", "-c", "-P", str(threads)]
+    if shutil.which("pugz"):
+        return ["pugz", "-t", str(threads)]
+    if shutil.which("unpigz"):
+        return ["unpigz", "-c", "-p", str(threads)]
+    return None
+
+
+def gunzip_files(paths, threads, command=None):
+    # zlib releases the GIL while inflating and commands run in their own
+    # processes, so threads decompress in parallel either way
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(partial(gunzip_file, command=command), paths))
+
+
+def write_file(path, data):
+    tmp_path = f"{path}.part"
+    with open(tmp_path, "wb") as out_file:
+        out_file.write(data)
+    os.replace(tmp_path, path)
+
+
+def extract_tarball(path, directory, threads):
+    # A streamed tar can only be read in order, so members are read here
+    # and written out by the pool while the next one is inflated.
+    # Like tar -k, files that already exist are kept.
+    try:
+        with gzip.open(path, "rb") as in_file, \
+                tarfile.open(fileobj=in_file, mode="r|") as tar, \
+                ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = []
+            for member in tar:
+                out_path = os.path.join(directory, member.name)
+                if not member.isfile() or os.path.isabs(member.name) or ".." in Path(member.name).parts:
+                    continue
+                if os.path.exists(out_path):
+                    continue
+
+                os.makedirs(os.path.dirname(out_path), exist_ok=True)
+                futures.append(executor.submit(write_file, out_path, tar.extractfile(member).read()))
+
+            for future in futures:
+                future.result()
+    except (tarfile.TarError, *GZIP_ERRORS) as e:
+        logger.warning(f"Failed to extract {path}: {e}")
+
+
 def run_basic_checks():
     if not shutil.which("kraken2-build"):
         logger.error("kraken2-build not found in PATH. Exiting.")
@@ -55,18 +269,50 @@ def create_cache_dir():
     # macOS ~/Library/Caches/kdb
     if sys.platform == "darwin":
         cache_dir = Path.home() / "Library" / "Caches" / "kdb"
-    if sys.platform == "linux":
+    else:
         cache_dir = Path.home() / ".cache" / "kdb"
 
     cache_dir.mkdir(parents=True, exist_ok=True)
     return cache_dir
 
 
-def download_taxanomy(cache_dir, skip_maps=None, protein=None):
+def download_url(session, url, directory, retries=20):
+    # Resume partial downloads like wget -c, and like wget retry with a growing wait
+    path = Path(directory, url.rsplit("/", 1)[-1])
+    for attempt in range(1, retries + 1):
+        offset = path.stat().st_size if path.exists() else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=60) as response:
+                if response.status_code == 416:
+                    # Nothing left past the offset, the file is complete
+                    return
+                response.raise_for_status()
+
+                mode = "ab" if response.status_code == 206 else "wb"
+                with open(path, mode) as out_file:
+                    for chunk in response.iter_content(chunk_size=1 << 20):
+                        out_file.write(chunk)
+            return
+        except requests.HTTPError as e:
+            if e.response.status_code < 500:
+                logger.warning(f"Failed to download {url}: {e}")
+                return
+            logger.warning(f"Failed to download {url}, attempt {attempt} of {retries}: {e}")
+        except requests.RequestException as e:
+            logger.warning(f"Failed to download {url}, attempt {attempt} of {retries}: {e}")
+
+        if attempt < retries:
+            time.sleep(min(attempt, 10))
+
+    logger.error(f"Giving up on {url} after {retries} attempts")
+
+
+def download_taxanomy(cache_dir, skip_maps=None, protein=None, threads=1):
     taxonomy_path = os.path.join(cache_dir, "taxonomy")
     os.makedirs(taxonomy_path, exist_ok=True)
-    os.chdir(taxonomy_path)
 
+    urls = []
     if not skip_maps:
         if not protein:
             # Define URLs for nucleotide accession to taxon map
@@ -76,64 +322,147 @@ def download_taxanomy(cache_dir, skip_maps=None, protein=None):
             ]
         else:
             # Define URL for protein accession to taxon map
-            urls = ["ftp://ftp.ncbi.nlm.nih.gov/pub/taxonomy/accession2taxid/prot.accession2taxid.gz"]
+            urls = [f"{NCBI_SERVER}/pub/taxonomy/accession2taxid/prot.accession2taxid.gz"]
     else:
         logger.info("Skipping maps download")
 
     # Download taxonomy tree data
     urls.append(f"{NCBI_SERVER}/pub/taxonomy/taxdump.tar.gz")
 
-    cmd = f"echo {' '.join(urls)} | xargs -n 1 -P 4 wget -q -c"
-    run_cmd(cmd, no_output=True)
+    if shutil.which("aria2c"):
+        # The accession maps are many GB each, fetch each one over several connections.
+        # One aria2c reads the whole list from stdin and keeps its connections alive.
+        cmd = [
+            "aria2c", "-q", "-c", "--auto-file-renaming=false",
+            "-x", "16", "-s", "16", "-j", "4", "-d", taxonomy_path, "-i", "-"
+        ]
+        subprocess.run(
+            cmd, input="\n".join(urls).encode(),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+    else:
+        # A shared session reuses connections to the NCBI server across files
+        with requests.Session() as session, ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(partial(download_url, session, directory=taxonomy_path), urls))
 
-    cmd = f"tar -k -xvf taxdump.tar.gz"
-    run_cmd(cmd, no_output=True)
+    extract_tarball(os.path.join(taxonomy_path, "taxdump.tar.gz"), taxonomy_path, threads)
 
     logger.info("Decompressing taxonomy data")
-    cmd = f"find {cache_dir}/taxonomy -name '*.gz' | xargs -n 1 gunzip -k"
-    run_cmd(cmd, no_output=True)
+    # taxdump.tar.gz is already extracted, only the accession maps need inflating
+    command = parallel_gunzip_command(threads)
+    gunzip_files(find_files(Path(cache_dir, "taxonomy"), "*.accession2taxid.gz"), threads, command)
 
     logger.info("Finished downloading taxonomy data")
 
 
 def run_cmd(cmd, return_output=False, no_output=False):
+    # argv lists run directly, only strings that need the shell go through it
+    shell = isinstance(cmd, str)
     if not no_output:
-        logger.info(f"Running command: {cmd}")
+        logger.info(f"Running command: {cmd if shell else ' '.join(cmd)}")
 
     if return_output:
-        return subprocess.check_output(cmd, shell=True).decode("utf-8").strip().split("\n")
+        return subprocess.check_output(cmd, shell=shell).decode("utf-8").strip().split("\n")
 
     try:
         if no_output:
-            subprocess.run(cmd, shell=True, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            subprocess.run(cmd, shell=shell, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         else:
-            subprocess.run(cmd, shell=True, check=True)
+            subprocess.run(cmd, shell=shell, check=True)
     except subprocess.CalledProcessError:
         pass
 
 
-def download_genomes(cache_dir, cwd, db_type, db_name, threads, force=False):
+def run_xargs(cmd, args, max_args=1, max_procs=1, no_output=False, cwd=None):
+    # Arguments go NUL separated over stdin, so any path is safe and argv never overflows
+    if not args:
+        return
+
+    argv = ["xargs", "-0", "-n", str(max_args), "-P", str(max_procs)] + cmd
+    if not no_output:
+        logger.info(f"Running command: {' '.join(argv)} with {len(args)} arguments")
+
+    output = subprocess.DEVNULL if no_output else None
+    subprocess.run(
+        argv, input=b"\0".join(os.fsencode(arg) for arg in args),
+        stdout=output, stderr=output, cwd=cwd
+    )
+
+
+def prepare_genome(path, fast_hash=False):
+    get_file_digest(path, max_threads=1, fast_hash=fast_hash)
+
+
+def download_organism(organism, cache_dir, threads, summary_ttl, progress_bar=True):
+    # ncbi-genome-download trusts its cached assembly summary for a day only.
+    # Keep our own copy for summary_ttl days and hand it over before downloading.
+    summary_name = f"refseq_{organism}_assembly_summary.txt"
+    summary_path = Path(cache_dir, "summaries", summary_name)
+    ngd_summary_path = Path(ncbi_genome_download.core.CACHE_DIR, summary_name)
+    summary_fresh = (
+        summary_path.exists() and
+        time.time() - summary_path.stat().st_mtime < summary_ttl * 24 * 60 * 60
+    )
+    if summary_fresh:
+        logger.info(f"Using cached assembly summary for {organism}")
+        ngd_summary_path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(summary_path, ngd_summary_path)
+        os.utime(ngd_summary_path)
+    elif ngd_summary_path.exists():
+        # Otherwise ncbi-genome-download would still reuse its own copy for up to a day
+        ngd_summary_path.unlink()
+
+    logger.info(f"Downloading genomes for {organism}")
+    ncbi_genome_download.download(
+        section='refseq', groups=organism, file_formats='fasta',
+        progress_bar=progress_bar, parallel=threads,
+        assembly_levels=['complete'],
+        output=cache_dir, use_cache=True
+    )
+
+    if not summary_fresh and ngd_summary_path.exists():
+        summary_path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(ngd_summary_path, summary_path)
+
+    return organism
+
+
+def download_genomes(
+        cache_dir, cwd, db_type, db_name, threads, force=False, fast_hash=False, summary_ttl=7
+):
     organisms = DB_TYPE_CONFIG.get(db_type, [db_type])
     if force:
         shutil.rmtree(cwd / db_name, ignore_errors=True)
 
     os.makedirs(cwd / db_name, exist_ok=True)
 
-    for organism in organisms:
-        logger.info(f"Downloading genomes for {organism}")
-        os.chdir(cache_dir)
-        ncbi_genome_download.download(
-            section='refseq', groups=organism, file_formats='fasta',
-            progress_bar=True, parallel=threads,
-            assembly_levels=['complete'],
-            output=cache_dir
-        )
-
-        cmd = f"find {cache_dir}/refseq/{organism} -name '*.gz' | xargs -n 1 -P {threads} gunzip -k"
-        run_cmd(cmd)
-        logger.info(f"Finished downloading {organism} genomes")
+    # Organisms download concurrently, and each one is hashed as soon as it
+    # finishes while the others are still downloading.
+    # ncbi-genome-download forks a pool of its own, so each organism runs in a
+    # freshly spawned process rather than forking from this threaded one.
+    # Progress bars of concurrent downloads would print over each other.
+    threads_per_organism = max(1, threads // len(organisms))
+    progress_bar = len(organisms) == 1
+    futures = []
+    spawn_context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=len(organisms), mp_context=spawn_context) as download_executor, \
+            ThreadPoolExecutor(max_workers=threads) as executor:
+        downloads = [
+            download_executor.submit(
+                download_organism, organism, cache_dir, threads_per_organism, summary_ttl, progress_bar
+            )
+            for organism in organisms
+        ]
+        for download in as_completed(downloads):
+            organism = download.result()
+            logger.info(f"Finished downloading {organism} genomes")
+
+            for path in find_files(Path(cache_dir, "refseq", organism), "*.fna.gz"):
+                futures.append(executor.submit(prepare_genome, path, fast_hash))
+
+        for future in futures:
+            future.result()
 
-    os.chdir(cwd)
     logger.info("Finished downloading all genomes")
 
 
@@ -141,14 +470,14 @@ def build_db(
         cache_dir, cwd, db_type, db_name, threads, kmer_len, min_len,
         fast_build, rebuild, load_factor, use_k2
 ):
-    run_cmd(f"cd {cwd}")
-
-    if not os.path.exists(f"{db_name}/taxonomy"):
-        cmd = f"ln -s {cache_dir}/taxonomy {db_name}/"
+    db_path = cwd / db_name
+    if not os.path.exists(f"{db_path}/taxonomy"):
+        cmd = ["ln", "-s", str(cache_dir / "taxonomy"), str(db_path)]
         run_cmd(cmd)
 
-    if rebuild:
-        cmd = f"rm -rf {db_name}/*.k2d"
+    k2d_files = [str(path) for path in db_path.glob("*.k2d")]
+    if rebuild and k2d_files:
+        cmd = ["rm", "-rf"] + k2d_files
         run_cmd(cmd)
 
     # TODO: Fix issue with macos threads
@@ -156,64 +485,257 @@ def build_db(
         threads = 1
 
     if use_k2:
-        cmd = f"k2 build"
+        cmd = ["k2", "build"]
     else:
-        cmd = f"kraken2-build --build"
+        cmd = ["kraken2-build", "--build"]
 
-    cmd += f" --db {db_name} --threads {threads} --kmer-len {kmer_len} --minimizer-len {min_len} --load-factor {load_factor}"
+    cmd += [
+        "--db", str(db_path), "--threads", str(threads), "--kmer-len", str(kmer_len),
+        "--minimizer-len", str(min_len), "--load-factor", str(load_factor),
+    ]
     if fast_build:
-        cmd += " --fast-build"
+        cmd.append("--fast-build")
 
     run_cmd(cmd)
 
-    cmd = f"du -sh {db_name}/*.k2d"
-    run_cmd(cmd)
+    k2d_files = [str(path) for path in db_path.glob("*.k2d")]
+    if k2d_files:
+        cmd = ["du", "-sh"] + k2d_files
+        run_cmd(cmd)
 
 
 def get_files(genomes_dir, cache_dir, db_type, db_name, threads):
     if genomes_dir:
         logger.info(f"Adding {genomes_dir} genomes to library")
 
-        cmd = f"find {genomes_dir} -name '*.gz' | xargs -n 1 -P {threads} gunzip -k"
-        run_cmd(cmd)
+        # Only genbank files need decompressing for any2fasta, compressed
+        # fasta files are read as they are, like downloaded genomes
+        gunzip_files(find_files(Path(genomes_dir), "*.gbff.gz"), threads)
 
-        cmd = f"find {genomes_dir} -name '*.gbff'"
-        files = run_cmd(cmd, return_output=True)
-        for file in files:
+        for file in find_files(Path(genomes_dir), "*.gbff"):
             if os.path.exists(f"{file}.fna"):
                 continue
-            cmd = f"any2fasta -u {file} > {file}.fna"
-            run_cmd(cmd)
+            cmd = ["any2fasta", "-u", file]
+            logger.info(f"Running command: {' '.join(cmd)} > {file}.fna")
+            # Write through a .part file so a failed conversion is retried next run
+            try:
+                with open(f"{file}.fna.part", "wb") as out_file:
+                    subprocess.run(cmd, stdout=out_file, check=True)
+            except subprocess.CalledProcessError as e:
+                logger.warning(f"Failed to convert {file}: {e}")
+                os.remove(f"{file}.fna.part")
+                continue
+            os.replace(f"{file}.fna.part", f"{file}.fna")
 
-        cmd = f"find {genomes_dir} -type f -name '*.fna'"
-        files = run_cmd(cmd, return_output=True)
+        files = find_files(Path(genomes_dir), "*.fna")
+        # Skip archives already decompressed by earlier versions
+        files.extend(
+            file for file in find_files(Path(genomes_dir), "*.fna.gz")
+            if not os.path.exists(file[:-3])
+        )
         logger.info(f"Found {len(files)} genomes to add to {db_name} library")
     else:
         organisms = DB_TYPE_CONFIG.get(db_type, [db_type])
         files = []
         for organism in organisms:
-            cmd = f"find {cache_dir}/refseq/{organism} -name '*.fna'"
-            org_files = run_cmd(cmd, return_output=True)
+            org_files = find_files(Path(cache_dir, "refseq", organism), "*.fna.gz")
             logger.info(f"Found {len(org_files)} genomes for {organism}")
             files.extend(org_files)
 
     return files
 
 
-def save_md5_file(*args, **kwargs):
-    global md5_file
-    with open(md5_file, "w") as out_file:
-        for line in hashes:
-            out_file.write(line + "\n")
-    logger.info(f"Saved {len(hashes)} md5 hashes")
+def load_hashes(hashes_file):
+    # Digests are stored back to back as raw DIGEST_SIZE byte records
+    hashes = set()
+    for path in (hashes_file, f"{hashes_file}.log"):
+        if os.path.exists(path):
+            with open(path, "rb") as in_file:
+                data = in_file.read()
+            end = len(data) - len(data) % DIGEST_SIZE
+            hashes.update(data[i:i + DIGEST_SIZE] for i in range(0, end, DIGEST_SIZE))
+
+    return hashes
+
+
+def compact_hashes_file(hashes_file):
+    # Fold the append-only log into a new snapshot and swap it in atomically
+    hashes = load_hashes(hashes_file)
+    tmp_file = f"{hashes_file}.tmp"
+    with open(tmp_file, "wb") as out_file:
+        out_file.write(b"".join(hashes))
+        out_file.flush()
+        os.fsync(out_file.fileno())
+
+    os.replace(tmp_file, hashes_file)
+    os.truncate(f"{hashes_file}.log", 0)
+    logger.info(f"Saved {len(hashes)} hashes")
+
+
+def load_legacy_md5_hashes(library_dir):
+    # Libraries built before the switch to blake3 recorded md5 digests
+    legacy_file = library_dir / "added.md5"
+    if not os.path.exists(legacy_file):
+        return set()
+
+    with open(legacy_file, "r") as in_file:
+        legacy_hashes = {line.strip() for line in in_file}
+
+    logger.info(f"Found {len(legacy_hashes)} legacy md5 hashes in {legacy_file}")
+    return legacy_hashes
+
+
+def is_legacy_added(file, legacy_hashes):
+    if not legacy_hashes:
+        return False
+
+    # Genomes used to be decompressed first, so their md5 sits next to the .fna
+    sidecars = [f"{file}.md5"]
+    if file.endswith(".gz"):
+        sidecars.append(f"{file[:-3]}.md5")
+
+    for sidecar in sidecars:
+        if os.path.exists(sidecar):
+            with open(sidecar, "r") as in_file:
+                if in_file.read().strip() in legacy_hashes:
+                    return True
+
+    return False
+
+
+def open_hash_cache(library_dir, fast_hash=False):
+    # Digests of genomes keyed by path, size and mtime, so unchanged files are never rehashed
+    table = "fingerprints" if fast_hash else "digests"
+    connection = sqlite3.connect(library_dir / "hash_cache.sqlite")
+    connection.execute(
+        f"CREATE TABLE IF NOT EXISTS {table} "
+        "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest BLOB)"
+    )
+    return connection, table
+
+
+def lookup_cached_digest(connection, table, file, size, mtime_ns):
+    row = connection.execute(
+        f"SELECT digest FROM {table} WHERE path = ? AND size = ? AND mtime_ns = ?",
+        (str(file), size, mtime_ns),
+    ).fetchone()
+    return row[0] if row else None
+
+
+def save_cached_digests(connection, table, rows):
+    connection.executemany(f"INSERT OR REPLACE INTO {table} VALUES (?, ?, ?, ?)", rows)
+    connection.commit()
+    rows.clear()
+
+
+def open_hashes_log(hashes_file):
+    log_file = f"{hashes_file}.log"
+    if os.path.exists(log_file):
+        # Drop a record torn by a crash so that new records stay aligned
+        size = os.path.getsize(log_file)
+        if size % DIGEST_SIZE:
+            os.truncate(log_file, size - size % DIGEST_SIZE)
+
+    return open(log_file, "ab", buffering=1 << 20)
+
+
+def sync_hashes_log(state):
+    state.hashes_log.flush()
+    os.fsync(state.hashes_log.fileno())
+    if os.fstat(state.hashes_log.fileno()).st_size >= HASHES_LOG_SIZE:
+        compact_hashes_file(state.hashes_file)
+
+
+def uncompressed_size(file, size):
+    # gzip stores the uncompressed size mod 2 ** 32 in its last 4 bytes
+    if not file.endswith(".gz") or size < 4:
+        return size
+
+    with open(file, "rb") as in_file:
+        in_file.seek(-4, os.SEEK_END)
+        isize = int.from_bytes(in_file.read(4), "little")
+    # The size wraps for genomes over 4 GiB, never count less than the compressed size
+    return max(isize, size)
+
+
+def write_shard(shard_path, files):
+    with open(shard_path, "wb") as out_file:
+        for file in files:
+            last = b"\n"
+            with open_genome(file) as in_file:
+                for chunk in iter(partial(in_file.read, 1 << 20), b""):
+                    out_file.write(chunk)
+                    last = chunk[-1:]
+
+            if last != b"\n":
+                # Keep the next genome's first header on its own line
+                out_file.write(b"\n")
+
+
+def find_kraken2_script(name):
+    # kraken2-build's helper scripts are installed next to the real kraken2-build
+    kraken2_build = shutil.which("kraken2-build")
+    if not kraken2_build:
+        return None
+
+    script = Path(os.path.realpath(kraken2_build)).parent / name
+    return script if script.exists() else None
+
+
+def add_shard(db_path, library_dir, files, threads, scan_script=None):
+    # kraken2-build takes one file per call, so add many genomes as one fasta
+    shard_fd, shard_path = tempfile.mkstemp(prefix="shard_", suffix=".fna.tmp", dir=library_dir)
+    os.close(shard_fd)
+    try:
+        write_shard(shard_path, files)
+
+        if scan_script:
+            # Like kraken2-build's add_to_library.sh, but the shard is moved instead of copied and
+            # low-complexity regions are NOT masked, so the database differs from a kraken2-build one
+            added_dir = library_dir / "added"
+            added_dir.mkdir(exist_ok=True)
+            map_fd, map_path = tempfile.mkstemp(prefix="prelim_map_", suffix=".txt", dir=added_dir)
+            try:
+                with os.fdopen(map_fd, "w") as map_file:
+                    subprocess.run([str(scan_script), str(shard_path)], stdout=map_file, check=True)
+            except BaseException:
+                # A partial map in library/added would be picked up by the build
+                os.remove(map_path)
+                raise
+
+            fna_fd, fna_path = tempfile.mkstemp(suffix=".fna", dir=added_dir)
+            os.close(fna_fd)
+            os.replace(shard_path, fna_path)
+        else:
+            # Unlike run_cmd, a failed add must raise so the shard is not recorded
+            cmd = ["kraken2-build", "--db", str(db_path), "--add-to-library", shard_path, "--threads", str(threads)]
+            subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+    finally:
+        if os.path.exists(shard_path):
+            os.remove(shard_path)
+
+    logger.info(f"Added shard of {len(files)} genomes to library")
+
+
+def record_shard(state, future, digests):
+    # Digests are only recorded once their shard is in the library.
+    # Genomes of a failed shard are left out and retried on the next run.
+    try:
+        future.result()
+    except subprocess.CalledProcessError as e:
+        logger.warning(f"Failed to add shard of {len(digests)} genomes to library: {e}")
+        return
+
+    state.hashes_log.write(b"".join(digests))
+    sync_hashes_log(state)
 
 
 def add_to_library(
         cache_dir, cwd, genomes_dir, db_type, db_name,
-        limit, batch_size, threads, use_k2
+        limit, batch_size, threads, use_k2, fast_hash=False, unsafe_fast_add=False
 ):
-    os.chdir(cwd)
-    os.makedirs(cwd / db_name / "library", exist_ok=True)
+    db_path = cwd / db_name
+    os.makedirs(db_path / "library", exist_ok=True)
 
     files = get_files(genomes_dir, cache_dir, db_type, db_name, threads)
     if limit:
@@ -232,58 +754,136 @@ def add_to_library(
     start = datetime.datetime.now()
 
     if use_k2:
-        for index, file in enumerate(files, start=1):
-            if index % step == 0:
-                duration = datetime.datetime.now() - start
-                average_speed = duration / step
-                eta = (file_count - index) * average_speed
-                logger.info(f"{datetime.datetime.now()}: Added {index} genomes in {duration}. ETA: {eta}")
-                start = datetime.datetime.now()
+        for index in range(0, file_count, batch_size):
+            batch = files[index:index + batch_size]
+            cmd = ["k2", "add-to-library", "--db", str(db_path), "--files"]
+            run_xargs(cmd, batch, max_args=len(batch), no_output=True)
 
-            cmd = f"k2 add-to-library --db {db_name} --files {file}"
-            run_cmd(cmd, no_output=True)
+            duration = datetime.datetime.now() - start
+            eta = (file_count - index - len(batch)) * duration / (index + len(batch))
+            logger.info(f"{datetime.datetime.now()}: Added {index + len(batch)} genomes in {duration}. ETA: {eta}")
 
         logger.info(f"Added downloaded genomes to library")
         end = datetime.datetime.now()
         print(f"Time taken: {end - start}")
         return
 
-    global hashes
-    global md5_file
-    md5_file = cwd / db_name / "library" / "added.md5"
-
-    if os.path.exists(md5_file):
-        with open(md5_file, "r") as in_file:
-            hashes = {line.strip() for line in in_file}
+    library_dir = db_path / "library"
+    # Full hashes and fingerprints are not comparable, so keep them apart
+    hashes_file = library_dir / ("added.fingerprint" if fast_hash else "added.blake3")
 
-        logger.info(f"Found {len(hashes)} md5 hashes in {md5_file}")
+    state = LibraryState(hashes_file, load_hashes(hashes_file))
+    logger.info(f"Found {len(state.hashes)} hashes in {hashes_file}")
 
-    for index, file in enumerate(files, start=1):
-        if index % step == 0:
-            duration = datetime.datetime.now() - start
-            average_speed = duration / step
-            eta = (file_count - index) * average_speed
-            logger.info(f"{datetime.datetime.now()}: Added {index} genomes in {duration}. ETA: {eta}")
-            start = datetime.datetime.now()
-
-        if not os.path.exists(f"{file}.md5"):
-            md5sum = hash_file(file)
-            with open(f"{file}.md5", "w") as fh:
-                fh.write(md5sum)
-        else:
-            with open(f"{file}.md5", "r") as in_file:
-                md5sum = in_file.read()
+    legacy_hashes = load_legacy_md5_hashes(library_dir)
 
-        if md5sum in hashes:
-            continue
+    scan_script = None
+    if unsafe_fast_add:
+        scan_script = find_kraken2_script("scan_fasta_file.pl")
+        if not scan_script:
+            logger.warning("scan_fasta_file.pl not found next to kraken2-build, using kraken2-build")
 
-        cmd = f"kraken2-build --db {db_name} --add-to-library {file} --threads {threads}"
-        run_cmd(cmd, no_output=True)
+    # Unchanged genomes take their digest from the cache, then the sidecar, and are hashed last
+    cache, cache_table = open_hash_cache(library_dir, fast_hash)
+    cache_rows = []
+    try:
+        file_stats = {}
+        digests = {}
+        missing_files = []
+        for file in files:
+            st = os.stat(file)
+            file_stats[file] = (st.st_size, st.st_mtime_ns)
+            digest = lookup_cached_digest(cache, cache_table, file, *file_stats[file])
+            if digest is not None:
+                digests[file] = digest
+                continue
 
-        with open(md5_file, "a") as out_file:
-            out_file.write(md5sum + "\n")
+            digest = read_digest_sidecar(file, fast_hash)
+            if digest is None:
+                missing_files.append(file)
+                continue
 
-        hashes.add(md5sum)
+            digests[file] = digest
+            cache_rows.append((str(file), *file_stats[file], digest))
+            if len(cache_rows) >= 500:
+                save_cached_digests(cache, cache_table, cache_rows)
+
+        logger.info(f"Found {len(digests)} cached digests")
+
+        # blake3 releases the GIL while hashing, so threads hash files in parallel
+        # and each one keeps blake3 single threaded to avoid oversubscription.
+        # Hashing runs ahead of the loop below, which writes sidecars and cache rows
+        # and fills shards as digests come in, so adding overlaps hashing.
+        # The log stays open for the whole run and is synced after every shard.
+        # A few shards are added concurrently, kraken2-build gives each one unique files.
+        logger.info(f"Hashing {len(missing_files)} genomes with {threads} threads")
+        shard_threads = max(1, threads // SHARD_WORKERS)
+        shard_files, shard_digests, shard_size = [], [], 0
+        pending = collections.deque()
+        with open_hashes_log(hashes_file) as state.hashes_log, \
+                ThreadPoolExecutor(max_workers=threads) as hash_executor, \
+                ThreadPoolExecutor(max_workers=SHARD_WORKERS) as executor:
+            compute = partial(hash_genome, max_threads=1, fast_hash=fast_hash)
+            # Only a few hashes run ahead of the loop, so a failure surfaces
+            # without waiting for the rest of the genomes to be hashed
+            pending_hashes = iter(missing_files)
+            hash_futures = {
+                file: hash_executor.submit(compute, file)
+                for file in itertools.islice(pending_hashes, threads * 4)
+            }
+            for index, file in enumerate(files, start=1):
+                if file in hash_futures:
+                    digest = hash_futures.pop(file).result()
+                    next_file = next(pending_hashes, None)
+                    if next_file is not None:
+                        hash_futures[next_file] = hash_executor.submit(compute, next_file)
+                    if digest is None:
+                        continue
+                    write_digest_sidecar(file, digest, fast_hash)
+                    cache_rows.append((str(file), *file_stats[file], digest))
+                    if len(cache_rows) >= 500:
+                        save_cached_digests(cache, cache_table, cache_rows)
+                else:
+                    digest = digests[file]
+
+                if index % step == 0:
+                    duration = datetime.datetime.now() - start
+                    average_speed = duration / step
+                    eta = (file_count - index) * average_speed
+                    logger.info(f"{datetime.datetime.now()}: Added {index} genomes in {duration}. ETA: {eta}")
+                    start = datetime.datetime.now()
+
+                if digest in state.hashes:
+                    continue
+
+                state.hashes.add(digest)
+                if is_legacy_added(file, legacy_hashes):
+                    state.hashes_log.write(digest)
+                    continue
+
+                shard_files.append(file)
+                shard_digests.append(digest)
+                shard_size += uncompressed_size(file, file_stats[file][0])
+                if shard_size >= SHARD_SIZE or len(shard_files) >= batch_size:
+                    future = executor.submit(add_shard, db_path, library_dir, shard_files, shard_threads, scan_script)
+                    pending.append((future, shard_digests))
+                    shard_files, shard_digests, shard_size = [], [], 0
+
+                    # Bound the number of shards written out but not yet added
+                    while len(pending) > SHARD_WORKERS:
+                        record_shard(state, *pending.popleft())
+
+            if shard_files:
+                future = executor.submit(add_shard, db_path, library_dir, shard_files, shard_threads, scan_script)
+                pending.append((future, shard_digests))
+
+            while pending:
+                record_shard(state, *pending.popleft())
+            sync_hashes_log(state)
+    finally:
+        # Rows hashed so far are kept even if adding fails
+        save_cached_digests(cache, cache_table, cache_rows)
+        cache.close()
 
     end = datetime.datetime.now()
     print(f"Time taken: {end - start}")
@@ -295,7 +895,7 @@ def add_to_library(
 @click.option('--db-type', default=None, help='database type to build')
 @click.option('--db-name', default=None, help='database name to build')
 @click.option('--genomes-dir', default=None, help='Directory containing genomes')
-@click.option('--cache-dir', default=create_cache_dir(), help='Cache directory')
+@click.option('--cache-dir', default=None, help='Cache directory. Defaults to the user cache directory')
 @click.option('--threads', default=multiprocessing.cpu_count(), help='Number of threads to use', type=int)
 @click.option('--load-factor', default=0.7, help='Proportion of the hash table to be populated')
 @click.option('--kmer-len', default=35, help='Kmer length in bp/aa. Used only in build task', type=int)
@@ -306,37 +906,48 @@ def add_to_library(
 @click.option('--rebuild', is_flag=True, help='Clean existing build files and re-build')
 @click.option('--fast-build', is_flag=True, help='Non deterministic but faster build')
 @click.option('--use-k2', is_flag=True, help='Non deterministic but faster build')
+@click.option('--unsafe-fast-add', is_flag=True, help='Add genomes to library without going through kraken2-build. Skips low-complexity masking')
+@click.option('--summary-ttl', default=7, help='Days to reuse cached NCBI assembly summaries', type=int)
+@click.option('--fast-hash', is_flag=True, envvar='KDB_FAST_HASH', help='Dedup genomes by file size, head and tail instead of full hash. Compressed and plain copies are not matched')
 @click.pass_context
 def main(
         context,
         db_type: str, db_name, cache_dir, genomes_dir,
         threads, load_factor, kmer_len: int, min_len, limit: int, batch_size: int,
-        force: bool, rebuild, fast_build: bool, use_k2: bool
+        force: bool, rebuild, fast_build: bool, use_k2: bool, unsafe_fast_add: bool,
+        summary_ttl: int, fast_hash: bool
 ):
     logger.info(f"Building Kraken2 database of type {db_type}")
     run_basic_checks()
     cwd = Path(os.getcwd())
 
-    if cache_dir == '.':
-        cache_dir = cwd
+    if cache_dir is None:
+        cache_dir = create_cache_dir()
+    cache_dir = Path(cache_dir).resolve()
 
     if not db_name:
         db_name = f"k2_{context.params['db_type']}"
 
     if force:
-        run_cmd(f"rm -rf {db_name}")
-        run_cmd(f"mkdir -p {db_name}")
+        run_cmd(["rm", "-rf", db_name])
+        run_cmd(["mkdir", "-p", db_name])
 
     logger.info(f"Using cache directory {cache_dir}")
 
-    download_taxanomy(cache_dir)
+    # Taxonomy and genomes live in separate cache subtrees, so fetch them concurrently
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(download_taxanomy, cache_dir, threads=threads)]
+        if not genomes_dir:
+            futures.append(executor.submit(
+                download_genomes, cache_dir, cwd, db_type, db_name, threads, force, fast_hash, summary_ttl
+            ))
 
-    if not genomes_dir:
-        download_genomes(cache_dir, cwd, db_type, db_name, threads, force)
+        for future in futures:
+            future.result()
 
     add_to_library(
         cache_dir, cwd, genomes_dir, db_type, db_name,
-        limit, batch_size, threads, use_k2
+        limit, batch_size, threads, use_k2, fast_hash, unsafe_fast_add
     )
     build_db(
         cache_dir, cwd, db_type, db_name, threads, kmer_len, min_len,